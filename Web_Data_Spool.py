@@ -1,85 +1,534 @@
 import streamlit as st
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
 from urllib.parse import quote_plus
 from sqlalchemy import create_engine
-from io import BytesIO
-import psutil
+from psycopg2 import sql
+from datetime import date, timedelta
+from decimal import Decimal
+from tempfile import SpooledTemporaryFile
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from contextlib import ExitStack
+from queue import Queue
+from threading import Lock
 import gzip
 
-# Fetch data with caching
-@st.cache_data(show_spinner="Fetching data from database...")
-def fetch_data_in_chunks(start_date, end_date, table_name, db_params, chunk_size=50000):
-    try:
-        password = quote_plus(db_params["password"])
-        engine = create_engine(
-            f"postgresql+psycopg2://{db_params['user']}:{password}@{db_params['host']}:{db_params['port']}/{db_params['database']}"
+# COPY output stays in RAM up to this size, then spills to a temp file
+SPOOL_MAX_SIZE = 64 * 1024 * 1024
+
+# Concurrent COPY streams per fetch, each on its own pooled connection; raise with care, the source DB pays for it
+FETCH_WORKERS = 4
+
+# Bytes of COPY output parsed per Arrow record batch
+CSV_BLOCK_SIZE = 8 * 1024 * 1024
+
+# Postgres type OID -> Arrow type for parsing COPY's CSV output; anything else is read as text.
+# Exact types such as numeric (1700) are deliberately absent, so their COPY text passes through untouched.
+# Dates and timestamps parse strictly: a range holding Postgres' infinity or a BC date fails the export with
+# Arrow's conversion error rather than being written out wrong.
+PG_ARROW_TYPES = {
+    16: pa.bool_(),  # bool
+    20: pa.int64(),  # int8
+    21: pa.int16(),  # int2
+    23: pa.int32(),  # int4
+    700: pa.float32(),  # float4
+    701: pa.float64(),  # float8
+    1082: pa.date32(),  # date
+    1114: pa.timestamp("us"),  # timestamp
+    1184: pa.timestamp("us", tz="UTC"),  # timestamptz
+}
+
+# CSV codec -> (file extension, max level, default level)
+CSV_CODECS = {
+    "zstd": ("csv.zst", 19, 3),
+    "gzip": ("csv.gz", 9, 1),
+}
+
+# Rows converted to Python values at a time when writing Excel rows
+EXCEL_BATCH_ROWS = 10_000
+
+# Rows reachable through preview paging
+PREVIEW_MAX_ROWS = 200_000
+
+# Excel sheet row limit, header row included
+EXCEL_MAX_ROWS = 1048576
+
+TABLE_MAPPING = {
+    "Deposit": "data_spool.b2c_collections",
+    "Withdrawals": "data_spool.b2c_payouts",
+    "Trongrid": "data_spool.trongrid",
+    "OKX Data": "data_spool.okx_data",
+    "App Transactions": "data_spool.in_app_transactions",
+    "Nobblet for Finance": "data_spool.nobblet_finance",
+    "Bitnob for Nobblet": "data_spool.nobblet_bitnob_records",
+    "Card Crossborder": "data_spool.card_crossborder_tbl",
+    "Card Terminations": "data_spool.card_termination_tbl"
+}
+
+# Half-open range on the bare column, so Postgres can use the index on transaction_date
+DATE_RANGE_FILTER = sql.SQL("transaction_date >= %s AND transaction_date < (%s::date + INTERVAL '1 day')")
+
+# Postgres numeric OID; numeric columns are carried as text and tagged so Excel can still write them as numbers
+PG_NUMERIC = 1700
+
+# Only tables exposed in the UI may ever be composed into a query
+def validate_table(table_name):
+    if table_name not in TABLE_MAPPING.values():
+        raise ValueError(f"Table {table_name!r} is not in the export allowlist")
+    return table_name
+
+def table_identifier(table_name):
+    return sql.Identifier(*validate_table(table_name).split("."))
+
+def select_list(columns):
+    return sql.SQL(", ").join(map(sql.Identifier, columns))
+
+def describe_columns(cur, table, columns):
+    cur.execute(sql.SQL("SELECT {columns} FROM {table} LIMIT 0").format(columns=select_list(columns), table=table))
+    return [
+        pa.field(col.name, PG_ARROW_TYPES.get(col.type_code, pa.string()),
+                 metadata={"pg_type": "numeric"} if col.type_code == PG_NUMERIC else None)
+        for col in cur.description
+    ]
+
+# Read connection settings from secrets once per process rather than on every rerun
+@st.cache_resource
+def load_db_params():
+    postgres = st.secrets["bitnob-servers"]["postgres"]
+    return {
+        "host": postgres["host"],
+        "port": postgres["port"],
+        "database": postgres["database"],
+        "user": postgres["user"],
+        "password": postgres["password"],
+    }
+
+# One engine (and connection pool) per process, shared across reruns and sessions
+@st.cache_resource
+def get_engine(db_params):
+    password = quote_plus(db_params["password"])
+    return create_engine(
+        f"postgresql+psycopg2://{db_params['user']}:{password}@{db_params['host']}:{db_params['port']}/{db_params['database']}",
+        pool_size=FETCH_WORKERS,
+        pool_pre_ping=True,
+        pool_recycle=1800,
+        connect_args={"sslmode": "require"},
+    )
+
+# Cached fetches are keyed on connection identity rather than the full params, so the password is never hashed
+def db_identity(db_params):
+    return (db_params["host"], db_params["port"], db_params["database"], db_params["user"])
+
+# Copy one date range out of Postgres into buf; COPY streams rows as they arrive, so libpq never buffers the result set
+def copy_range(start_date, end_date, table_name, columns, conn, buf):
+    query = sql.SQL("""
+        COPY (
+            SELECT {columns}
+            FROM {table}
+            WHERE {date_range}
+        ) TO STDOUT WITH (FORMAT CSV, HEADER)
+    """).format(columns=select_list(columns), table=table_identifier(table_name), date_range=DATE_RANGE_FILTER)
+
+    with conn.cursor() as cur:
+        # COPY takes no bind parameters, so the dates are mogrified into the statement
+        cur.copy_expert(cur.mogrify(query, (start_date, end_date)), buf)
+
+# Split an inclusive date range into up to `parts` contiguous inclusive sub-ranges of whole days
+def split_date_range(start_date, end_date, parts):
+    start, end = date.fromisoformat(start_date), date.fromisoformat(end_date)
+    days = (end - start).days + 1
+    if days <= 1:
+        return [(start_date, end_date)]
+    parts = min(parts, days)
+    bounds = [start + timedelta(days=days * i // parts) for i in range(parts + 1)]
+    return [(bounds[i].isoformat(), (bounds[i + 1] - timedelta(days=1)).isoformat()) for i in range(parts)]
+
+def iter_batches(start_date, end_date, table_name, columns, engine, column_types, block_size, stop):
+    ranges = split_date_range(start_date, end_date, FETCH_WORKERS)
+    # Unwound in reverse: the executor is exited (and every COPY finished), then the connections go back
+    # to the pool, then the spools they wrote into are closed
+    with ExitStack() as stack:
+        spools = [stack.enter_context(SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)) for _ in ranges]
+        # Each sub-range streams over its own pooled connection, so one backend and one socket aren't the bottleneck.
+        # The connections are held here rather than in the workers so unfinished COPYs can be cancelled.
+        conns = []
+        for _ in ranges:
+            conns.append(engine.raw_connection())
+            stack.callback(conns[-1].close)
+        executor = stack.enter_context(ThreadPoolExecutor(max_workers=len(ranges)))
+        futures = [
+            executor.submit(copy_range, *date_range, table_name, columns, conn, buf)
+            for date_range, conn, buf in zip(ranges, conns, spools)
+        ]
+        try:
+            yield from parse_partitions(futures, spools, column_types, block_size, stop)
+        finally:
+            # A failed partition or an early close() shouldn't wait for the rest of the range to download.
+            # The cancel is repeated because one sent before a worker's COPY reaches the server is a no-op.
+            for conn, future in zip(conns, futures):
+                while not future.done():
+                    conn.cancel()
+                    wait([future], timeout=1)
+
+# Partitions are parsed in date order as soon as each one lands, while later ones are still downloading
+def parse_partitions(futures, spools, column_types, block_size, stop):
+    for future, buf in zip(futures, spools):
+        # Resolving stop ends the stream even while a partition is still downloading
+        wait([future, stop], return_when=FIRST_COMPLETED)
+        if not future.done():
+            return
+        future.result()
+        buf.seek(0)
+        # Every column has a declared type, so Arrow parses straight into typed arrays with no inference.
+        # COPY writes NULL as an empty field and an empty string as "", and t/f for booleans. Quoted
+        # values may span lines, and a single-column NULL row is an empty line that must still count.
+        yield from pacsv.open_csv(
+            buf,
+            read_options=pacsv.ReadOptions(block_size=block_size),
+            parse_options=pacsv.ParseOptions(newlines_in_values=True, ignore_empty_lines=False),
+            convert_options=pacsv.ConvertOptions(
+                column_types=column_types,
+                null_values=[""],
+                true_values=["t"],
+                false_values=["f"],
+                strings_can_be_null=True,
+                quoted_strings_can_be_null=False,
+            ),
         )
-        conn = engine.connect()
-        query = f"""
-            SELECT * 
-            FROM {table_name}
-            WHERE transaction_date::date BETWEEN %s AND %s
-        """
 
-        chunks = []
-        for chunk in pd.read_sql_query(query, con=conn, params=(start_date, end_date), chunksize=chunk_size):
-            chunks.append(chunk)
+# Stream the range as Arrow record batches, one per parsed block. Every partition is spooled at once,
+# so up to FETCH_WORKERS * SPOOL_MAX_SIZE of COPY output sits in RAM before the spools spill to disk.
+# `stop` is a Future that is never run; resolving it from any thread ends the stream early.
+def stream_batches(start_date, end_date, table_name, columns, db_params, stop=None, block_size=CSV_BLOCK_SIZE):
+    engine = get_engine(db_params)
+    conn = engine.raw_connection()
+    try:
+        with conn.cursor() as cur:
+            schema = pa.schema(describe_columns(cur, table_identifier(table_name), columns))
+    finally:
+        conn.close()
+    column_types = dict(zip(schema.names, schema.types))
+    if stop is None:
+        stop = Future()
+    return schema, iter_batches(start_date, end_date, table_name, columns, engine, column_types, block_size, stop)
 
+# Column names for the column picker, in table order; errors propagate so a failed lookup is never cached
+@st.cache_data(ttl="1h", max_entries=16, show_spinner=False, hash_funcs={dict: db_identity})
+def fetch_columns(table_name, db_params):
+    schema, table = validate_table(table_name).split(".")
+    conn = get_engine(db_params).raw_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT column_name
+                FROM information_schema.columns
+                WHERE table_schema = %s AND table_name = %s
+                ORDER BY ordinal_position
+            """, (schema, table))
+            return [row[0] for row in cur.fetchall()]
+    finally:
         conn.close()
-        return pd.concat(chunks, ignore_index=True)
+
+# Primary key columns, used to give the preview a total order; empty for views and tables without one
+@st.cache_data(ttl="1h", max_entries=16, show_spinner=False, hash_funcs={dict: db_identity})
+def fetch_primary_key(table_name, db_params):
+    validate_table(table_name)
+    conn = get_engine(db_params).raw_connection()
+    try:
+        with conn.cursor() as cur:
+            # Partitioned parents carry their own primary key index, so this covers partitioned tables too
+            cur.execute("""
+                SELECT a.attname
+                FROM pg_index i
+                JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey)
+                WHERE i.indrelid = to_regclass(%s) AND i.indisprimary
+                ORDER BY array_position(i.indkey::int2[], a.attnum)
+            """, (table_name,))
+            return [row[0] for row in cur.fetchall()]
+    finally:
+        conn.close()
+
+# Row count for the selected range, used to size the preview pagination.
+# Errors propagate to the caller, since st.cache_data never caches a raised exception.
+@st.cache_data(ttl="15m", max_entries=8, show_spinner="Counting rows...", hash_funcs={dict: db_identity})
+def count_rows(start_date, end_date, table_name, db_params):
+    query = sql.SQL("""
+        SELECT count(*)
+        FROM {table}
+        WHERE {date_range}
+    """).format(table=table_identifier(table_name), date_range=DATE_RANGE_FILTER)
+    conn = get_engine(db_params).raw_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(query, (start_date, end_date))
+            return cur.fetchone()[0]
+    finally:
+        conn.close()
+
+# Fetch a single preview page; only rows_per_page rows leave the server
+@st.cache_data(ttl="1m", max_entries=32, show_spinner=False, hash_funcs={dict: db_identity})
+def fetch_preview(start_date, end_date, table_name, columns, db_params, page, rows_per_page):
+    # transaction_date isn't unique, so ties are broken on the primary key (or, lacking one, the whole
+    # row's text, which any relation has) and pages neither repeat nor skip rows
+    key = fetch_primary_key(table_name, db_params)
+    tiebreaker = select_list(key) if key else sql.SQL("spool_row::text")
+    query = sql.SQL("""
+        SELECT {columns}
+        FROM {table} AS spool_row
+        WHERE {date_range}
+        ORDER BY transaction_date, {tiebreaker}
+        LIMIT %s OFFSET %s
+    """).format(
+        columns=select_list(columns),
+        table=table_identifier(table_name),
+        date_range=DATE_RANGE_FILTER,
+        tiebreaker=tiebreaker,
+    )
+    conn = get_engine(db_params).raw_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(query, (start_date, end_date, rows_per_page, (page - 1) * rows_per_page))
+            return pd.DataFrame(cur.fetchall(), columns=[col.name for col in cur.description])
+    finally:
+        conn.close()
+
+def to_excel(schema, batches):
+    import xlsxwriter
+
+    with SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE) as output:
+        # constant_memory flushes each row to disk as soon as the next one starts, so rows
+        # are written in order here rather than through pandas' to_excel (which goes column by column)
+        workbook = xlsxwriter.Workbook(output, {
+            "constant_memory": True,
+            "strings_to_urls": False,
+            "strings_to_formulas": False,
+            "remove_timezone": True,
+            "nan_inf_to_errors": True,
+            "default_date_format": "yyyy-mm-dd hh:mm:ss",
+        })
+        workbook.use_zip64()
+        worksheet = workbook.add_worksheet("Data")
+        worksheet.write_row(0, 0, schema.names, workbook.add_format({"bold": True}))
+        # Plain dates would otherwise pick up the default datetime format and show a midnight time
+        date_format = workbook.add_format({"num_format": "yyyy-mm-dd"})
+        formats = [date_format if pa.types.is_date(field.type) else None for field in schema]
+        numeric = [i for i, field in enumerate(schema) if (field.metadata or {}).get(b"pg_type") == b"numeric"]
+        row_idx = 1
+        for batch in batches:
+            if row_idx + batch.num_rows > EXCEL_MAX_ROWS:
+                raise ValueError(f"Export exceeds Excel's limit of {EXCEL_MAX_ROWS - 1:,} data rows")
+            for offset in range(0, batch.num_rows, EXCEL_BATCH_ROWS):
+                part = batch.slice(offset, EXCEL_BATCH_ROWS)
+                # Nulls come out of to_pylist() as None, which xlsxwriter leaves blank
+                values = [column.to_pylist() for column in part.columns]
+                # numeric arrives as exact text; Decimal makes xlsxwriter write it as a number cell
+                for i in numeric:
+                    values[i] = [None if value is None else Decimal(value) for value in values[i]]
+                for row in zip(*values):
+                    for col_idx, (value, cell_format) in enumerate(zip(row, formats)):
+                        worksheet.write(row_idx, col_idx, value, cell_format)
+                    row_idx += 1
+        workbook.close()
+
+        output.seek(0)
+        return output.read()
+
+def write_csv(schema, batches, sink):
+    # Arrow's C++ writer formats whole columns at a time instead of cell by cell
+    with pacsv.CSVWriter(sink, schema) as writer:
+        for batch in batches:
+            writer.write_batch(batch)
+
+# The compressed builds write into a spool like to_excel, so past SPOOL_MAX_SIZE the file sits on disk
+# and only the bytes returned for the download are held in memory
+def to_compressed_csv(schema, batches, level=1):
+    with SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE) as out:
+        with gzip.GzipFile(fileobj=out, mode='wb', compresslevel=level) as f:
+            write_csv(schema, batches, f)
+        out.seek(0)
+        return out.read()
+
+def to_zstd_csv(schema, batches, level=3):
+    import zstandard as zstd
+
+    with SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE) as out:
+        cctx = zstd.ZstdCompressor(level=level, threads=-1)
+        with cctx.stream_writer(out, closefd=False) as f:
+            write_csv(schema, batches, f)
+        out.seek(0)
+        return out.read()
+
+def to_parquet(schema, batches):
+    import pyarrow.parquet as pq
+
+    with SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE) as out:
+        with pq.ParquetWriter(out, schema, compression='zstd') as writer:
+            for batch in batches:
+                writer.write_batch(batch)
+        out.seek(0)
+        return out.read()
+
+# Feed every batch to each build through its own small queue, so the range is fetched once, all formats
+# are written concurrently, and no more than a few batches are in flight. `stop` is the Future the batches
+# were streamed with, so the fetch can be abandoned once no build is left to feed.
+def run_exports(schema, batches, builds, stop):
+    queues = [Queue(maxsize=2) for _ in builds]
+    pending = len(builds)
+    lock = Lock()
+
+    def consume(build, queue):
+        nonlocal pending
+        queued = iter(queue.get, None)
+        try:
+            return build(schema, queued)
+        finally:
+            # Builds only finish early by failing; once none is left to feed, stop fetching
+            with lock:
+                pending -= 1
+                if not pending:
+                    stop.set_result(None)
+            # A build that stopped early keeps draining so the producer never blocks on a full queue
+            for _ in queued:
+                pass
+
+    with ThreadPoolExecutor(max_workers=len(builds)) as executor:
+        futures = [executor.submit(consume, build, queue) for build, queue in zip(builds, queues)]
+        try:
+            for batch in batches:
+                if stop.done():
+                    break
+                for queue in queues:
+                    queue.put(batch)
+        finally:
+            for queue in queues:
+                queue.put(None)
+            # Cancels whatever is still being fetched, instead of waiting for the generator to be collected
+            batches.close()
+    return futures
+
+# Resource probes run on every rerun, so their readings are cached briefly
+@st.cache_data(ttl=2, show_spinner=False)
+def memory_snapshot():
+    import psutil
+
+    mem = psutil.virtual_memory()
+    return mem.percent, mem.used, mem.total
+
+def display_memory_usage():
+    percent, used, total = memory_snapshot()
+    st.caption(f"🔋 Memory used: {percent:.2f}% — {used // (1024**2)} MB / {total // (1024**2)} MB")
+
+# Paging only reruns this fragment, and each page is fetched on its own
+@st.fragment
+def preview_section(selection, db_params, total_rows):
+    table_choice, start_date, end_date, columns = selection
+
+    # Deep OFFSETs make the server walk every skipped row, so huge ranges only preview their first rows
+    preview_rows = min(total_rows, PREVIEW_MAX_ROWS)
+    if preview_rows < total_rows:
+        st.caption(f"Previewing the first {preview_rows:,} rows; exports include all {total_rows:,}.")
+
+    rows_per_page = st.slider("Rows per page", 10, 100, 25)
+    total_pages = (preview_rows - 1) // rows_per_page + 1
+    page = st.number_input("Page", 1, total_pages, 1)
+    try:
+        st.dataframe(fetch_preview(start_date, end_date, TABLE_MAPPING[table_choice], columns, db_params, page, rows_per_page))
+    except Exception as e:
+        st.error(f"Error fetching preview: {e}")
+
+# Stream the range straight into the requested formats and keep the files for the download buttons.
+# Serializers spend most of their time in native code that releases the GIL, so they run side by side.
+def prepare_exports(exports, selection, db_params, targets):
+    table_choice, start_date, end_date, columns = selection
+    try:
+        with st.spinner("Exporting data from database..."):
+            stop = Future()
+            schema, batches = stream_batches(start_date, end_date, TABLE_MAPPING[table_choice], columns, db_params, stop)
+            futures = run_exports(schema, batches, [build for build, _ in targets.values()], stop)
     except Exception as e:
         st.error(f"Error fetching data: {e}")
-        return pd.DataFrame()
+        return
 
-def to_excel(df):
-    output = BytesIO()
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        df.to_excel(writer, index=False, sheet_name='Data')
-    return output.getvalue()
+    for (key, (_, file_name)), future in zip(targets.items(), futures):
+        try:
+            exports[key] = (file_name, future.result())
+        except Exception as e:
+            st.error(f"Error preparing {file_name}: {e}")
 
-def to_compressed_csv(df):
-    out = BytesIO()
-    with gzip.GzipFile(fileobj=out, mode='w') as f:
-        f.write(df.to_csv(index=False).encode('utf-8'))
-    return out.getvalue()
+# Exports are only built when asked for, and widgets in here rerun just this fragment
+@st.fragment
+def export_section(selection, db_params, total_rows):
+    table_choice, start_date, end_date, columns = selection
+    file_stem = f"{table_choice}_{start_date}_to_{end_date}"
+    # Refuse Excel up front rather than failing after a million rows have been fetched
+    excel_fits = total_rows < EXCEL_MAX_ROWS
 
-def display_memory_usage():
-    mem = psutil.virtual_memory()
-    st.caption(f"🔋 Memory used: {mem.percent:.2f}% — {mem.used // (1024**2)} MB / {mem.total // (1024**2)} MB")
+    # Files built for an earlier selection are stale
+    if st.session_state.get("export_selection") != selection:
+        st.session_state["export_selection"] = selection
+        st.session_state["exports"] = {}
+    exports = st.session_state["exports"]
+
+    together = st.checkbox(
+        "Prepare Excel and CSV together",
+        help="Builds both files in parallel from a single pass over the data.",
+        disabled=not excel_fits,
+    ) and excel_fits
+    col1, col2, col3 = st.columns(3)
+    if not excel_fits:
+        col1.caption(f"Excel holds at most {EXCEL_MAX_ROWS - 1:,} data rows; use CSV or Parquet for this range.")
+    with col2:
+        csv_codec = st.radio("CSV compression", list(CSV_CODECS.keys()), horizontal=True)
+        csv_extension, max_level, default_level = CSV_CODECS[csv_codec]
+        compress_level = st.slider("Compression level (lower is faster, higher is smaller)", 1, max_level, default_level)
+    to_csv = to_zstd_csv if csv_codec == "zstd" else to_compressed_csv
+    builders = {
+        "xlsx": (to_excel, f"{file_stem}.xlsx"),
+        "csv": (lambda schema, batches: to_csv(schema, batches, compress_level), f"{file_stem}.{csv_extension}"),
+        "parquet": (to_parquet, f"{file_stem}.parquet"),
+    }
+
+    requested = []
+    if col1.button("Prepare Excel", disabled=not excel_fits):
+        requested = ["xlsx", "csv"] if together else ["xlsx"]
+    if col2.button("Prepare Compressed CSV"):
+        requested = ["xlsx", "csv"] if together else ["csv"]
+    if col3.button("Prepare Parquet"):
+        requested = ["parquet"]
+    if requested:
+        prepare_exports(exports, selection, db_params, {key: builders[key] for key in requested})
+
+    for col, key, label in (
+        (col1, "xlsx", "⬇️ Download as Excel"),
+        (col2, "csv", "⬇️ Download as Compressed CSV"),
+        (col3, "parquet", "⬇️ Download as Parquet"),
+    ):
+        if key in exports:
+            file_name, data = exports[key]
+            col.download_button(label, data, file_name=file_name)
 
 # Streamlit UI
 def main():
     st.set_page_config("PostgreSQL Data Export", layout="wide")
     st.title("📊 PostgreSQL Data Export Tool")
-    st.markdown("Export filtered records from a PostgreSQL table as Excel or compressed CSV.")
+    st.markdown("Export filtered records from a PostgreSQL table as Excel, compressed CSV or Parquet.")
 
     display_memory_usage()
 
     try:
-        db_params = {
-            "host": st.secrets["bitnob-servers"]["postgres"]["host"],
-            "port": st.secrets["bitnob-servers"]["postgres"]["port"],
-            "database": st.secrets["bitnob-servers"]["postgres"]["database"],
-            "user": st.secrets["bitnob-servers"]["postgres"]["user"],
-            "password": st.secrets["bitnob-servers"]["postgres"]["password"],
-        }
+        db_params = load_db_params()
     except KeyError as e:
         st.error(f"Missing key in secrets: {e}")
         st.stop()
 
-    table_mapping = {
-        "Deposit": "data_spool.b2c_collections",
-        "Withdrawals": "data_spool.b2c_payouts",
-        "Trongrid": "data_spool.trongrid",
-        "OKX Data": "data_spool.okx_data",
-        "App Transactions": "data_spool.in_app_transactions",
-        "Nobblet for Finance": "data_spool.nobblet_finance",
-        "Bitnob for Nobblet": "data_spool.nobblet_bitnob_records",
-        "Card Crossborder": "data_spool.card_crossborder_tbl",
-        "Card Terminations": "data_spool.card_termination_tbl"
-    }
-
-    table_choice = st.selectbox("Select Table", list(table_mapping.keys()))
+    table_choice = st.selectbox("Select Table", list(TABLE_MAPPING.keys()))
+    try:
+        available_columns = fetch_columns(TABLE_MAPPING[table_choice], db_params)
+    except Exception as e:
+        st.error(f"Error fetching columns: {e}")
+        st.stop()
+    columns = st.multiselect("Columns", available_columns, default=available_columns)
     start_date = st.date_input("Start Date")
     end_date = st.date_input("End Date")
 
@@ -87,29 +536,29 @@ def main():
     end_date = end_date.strftime('%Y-%m-%d')
 
     if st.button("Fetch and Preview Data"):
-        df = fetch_data_in_chunks(start_date, end_date, table_mapping[table_choice], db_params)
-        if not df.empty:
-            st.success(f"Fetched {len(df):,} rows.")
-            rows_per_page = st.slider("Rows per page", 10, 100, 25)
-            total_pages = (len(df) - 1) // rows_per_page + 1
-            page = st.number_input("Page", 1, total_pages, 1)
-            st.dataframe(df.iloc[(page - 1) * rows_per_page : page * rows_per_page])
-            
-            col1, col2 = st.columns(2)
-            with col1:
-                st.download_button(
-                    "⬇️ Download as Excel",
-                    to_excel(df),
-                    file_name=f"{table_choice}_{start_date}_to_{end_date}.xlsx"
-                )
-            with col2:
-                st.download_button(
-                    "⬇️ Download as Compressed CSV (.gz)",
-                    to_compressed_csv(df),
-                    file_name=f"{table_choice}_{start_date}_to_{end_date}.csv.gz"
-                )
-        else:
-            st.warning("No data returned for the selected date range and table.")
+        if not columns:
+            st.warning("Select at least one column.")
+            st.stop()
+        st.session_state["selection"] = (table_choice, start_date, end_date, tuple(columns))
+
+    # Keep the preview on screen across reruns triggered by the widgets below
+    if "selection" not in st.session_state:
+        return
+    table_choice, start_date, end_date, columns = st.session_state["selection"]
+    table_name = TABLE_MAPPING[table_choice]
+
+    try:
+        total_rows = count_rows(start_date, end_date, table_name, db_params)
+    except Exception as e:
+        st.error(f"Error counting rows: {e}")
+        return
+    if not total_rows:
+        st.warning("No data returned for the selected date range and table.")
+        return
+
+    st.success(f"Found {total_rows:,} rows.")
+    preview_section(st.session_state["selection"], db_params, total_rows)
+    export_section(st.session_state["selection"], db_params, total_rows)
 
 if __name__ == "__main__":
     main()